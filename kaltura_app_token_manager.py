@@ -1,24 +1,11 @@
 #!/usr/bin/env python3
 import os
+import sys
 import argparse
-import hashlib
-import json
-import logging
-from KalturaClient import KalturaClient, KalturaConfiguration
-from KalturaClient.Plugins.Core import (KalturaAppToken, KalturaAppTokenFilter, KalturaFilterPager, KalturaSessionType, KalturaAppTokenHashType)
-from KalturaClient.exceptions import KalturaException
-
-# Custom logger class
-class KalturaLogger:
-    def __init__(self):
-        self.logger = logging.getLogger('KalturaClient')
-        logging.basicConfig(level=logging.DEBUG)
-
-    def log(self, msg):
-        self.logger.info(msg)
-
-    def debug(self, msg):
-        self.logger.debug(msg)
+import signal
+from kaltura_common import start_app_token_session, load_configuration, initialize_client, fetch_all_app_tokens
+# KalturaClient (and requests) are imported inside the functions that use them,
+# loading the generated API classes is slow and not needed for --help or argument errors
 
 # Privilege handling functions
 def handle_privilege(privilege_name, value):
@@ -53,29 +40,35 @@ PRIVILEGE_HANDLERS = {
     'sessionid': handle_privilege,
 }
 
+# argparse options for each privilege flag ('list' is added separately, it doubles as the list command)
+_PRIV_ARG_SPECS = {
+    'edit': {'type': str, 'help': 'Set the edit privilege. Expects entry id or * for wildcard.'},
+    'sview': {'type': str, 'help': 'Set the sview privilege. Expects entry id or * for wildcard.'},
+    'download': {'type': str, 'help': 'Set the download privilege. Expects entry id or * for wildcard.'},
+    'downloadasset': {'type': str, 'help': 'Set the downloadasset privilege. Expects asset id or *.'},
+    'editplaylist': {'type': str, 'help': 'Set the editplaylist privilege. Expects the id of the playlist.'},
+    'sviewplaylist': {'type': str, 'help': 'Set the sviewplaylist privilege. Expects the id of the playlist.'},
+    'edituser': {'type': str, 'help': 'Set the edituser privilege. * or a list of usernames separated by /.'},
+    'actionslimit': {'type': int, 'help': 'Set the actionslimit privilege. Expects an integer.'},
+    'setrole': {'type': str, 'help': 'Set the setrole privilege. Expects the id of the role.'},
+    'iprestrict': {'type': str, 'help': 'Set the iprestrict privilege. Only a single address is allowed.'},
+    'urirestrict': {'type': str, 'help': 'Set the urirestrict privilege. A URI, * as a prefix allowed.'},
+    'enableentitlement': {'action': 'store_true', 'help': 'Force entitlement checks.'},
+    'disableentitlement': {'action': 'store_true', 'help': 'Bypass entitlement checks.'},
+    'disableentitlementforentry': {'type': str, 'help': 'Bypass entitlement for a given entry id.'},
+    'privacycontext': {'type': str, 'help': 'Set the privacy context for entitlement checks.'},
+    'enablecategorymoderation': {'action': 'store_true', 'help': 'Enable category moderation.'},
+    'reftime': {'type': int, 'help': 'Set the reftime privilege. Expects a Unix timestamp.'},
+    'preview': {'type': int, 'help': 'Set the preview privilege. Size in bytes.'},
+    'sessionid': {'type': str, 'help': 'Set the sessionid. An arbitrary string identifying the session.'},
+}
+
 # Initialize parser with dynamic privileges based on the handlers
 def setup_parser():
     parser = argparse.ArgumentParser(description='Manage Kaltura App Tokens with dynamic privileges.')
-    # Add arguments for each privilege type with the correct handler
-    parser.add_argument('--edit', type=str, help='Set the edit privilege. Expects entry id or * for wildcard.')
-    parser.add_argument('--sview', type=str, help='Set the sview privilege. Expects entry id or * for wildcard.')
-    parser.add_argument('--download', type=str, help='Set the download privilege. Expects entry id or * for wildcard.')
-    parser.add_argument('--downloadasset', type=str, help='Set the downloadasset privilege. Expects asset id or *.')
-    parser.add_argument('--editplaylist', type=str, help='Set the editplaylist privilege. Expects the id of the playlist.')
-    parser.add_argument('--sviewplaylist', type=str, help='Set the sviewplaylist privilege. Expects the id of the playlist.')
-    parser.add_argument('--edituser', type=str, help='Set the edituser privilege. * or a list of usernames separated by /.')
-    parser.add_argument('--actionslimit', type=int, help='Set the actionslimit privilege. Expects an integer.')
-    parser.add_argument('--setrole', type=str, help='Set the setrole privilege. Expects the id of the role.')
-    parser.add_argument('--iprestrict', type=str, help='Set the iprestrict privilege. Only a single address is allowed.')
-    parser.add_argument('--urirestrict', type=str, help='Set the urirestrict privilege. A URI, * as a prefix allowed.')
-    parser.add_argument('--enableentitlement', action='store_true', help='Force entitlement checks.')
-    parser.add_argument('--disableentitlement', action='store_true', help='Bypass entitlement checks.')
-    parser.add_argument('--disableentitlementforentry', type=str, help='Bypass entitlement for a given entry id.')
-    parser.add_argument('--privacycontext', type=str, help='Set the privacy context for entitlement checks.')
-    parser.add_argument('--enablecategorymoderation', action='store_true', help='Enable category moderation.')
-    parser.add_argument('--reftime', type=int, help='Set the reftime privilege. Expects a Unix timestamp.')
-    parser.add_argument('--preview', type=int, help='Set the preview privilege. Size in bytes.')
-    parser.add_argument('--sessionid', type=str, help='Set the sessionid. An arbitrary string identifying the session.')
+    # Add arguments for each privilege type
+    for name, spec in _PRIV_ARG_SPECS.items():
+        parser.add_argument(f'--{name}', **spec)
     # Set the description of the app token
     parser.add_argument('--description', type=str, help='Description for the app token.')
     # Add the update argument
@@ -91,6 +84,7 @@ def setup_parser():
 
 # Deletes an app token
 def delete_app_token(client, app_token_id):
+    from KalturaClient.exceptions import KalturaException
     try:
         # Delete the app token using the Kaltura API
         client.appToken.delete(app_token_id)
@@ -98,43 +92,60 @@ def delete_app_token(client, app_token_id):
     except KalturaException as e:
         print(f"Error deleting App Token with ID {app_token_id}: {e}")
 
+# Privilege names in declaration order, precomputed once for build_privileges
+_PRIV_NAMES = tuple(PRIVILEGE_HANDLERS)
+
 # Function to build privileges
 def build_privileges(args):
-    privileges = []
-    for privilege, handler in PRIVILEGE_HANDLERS.items():
-        value = getattr(args, privilege, None)
-        if value is not None:
-            # Call the handler function if it's callable, otherwise use the value as is (for 'list')
-            if callable(handler):
-                privilege_str = handler(privilege, value)
-            else:
-                privilege_str = handler
-            privileges.append(privilege_str)
-    return ','.join(privileges)
+    # 'list' only supports the wildcard, every other privilege is formatted as 'privilege_name:value'
+    parts = [('list:*' if name == 'list' else f"{name}:{value}")
+             for name in _PRIV_NAMES if (value := getattr(args, name, None)) is not None]
+    return ','.join(parts)
 
-# word-wrap function that wraps text on exactly width characters
+# word-wrap function that lazily yields text in chunks of exactly width characters
 def wrap_text(text, width):
-    return [text[i:i+width] for i in range(0, len(text), width)]
+    # most privilege strings fit on one line, skip the slicing generator for them
+    if len(text) <= width:
+        return iter((text,) if text else ())
+    return (text[i:i+width] for i in range(0, len(text), width))
+
+# Cached terminal width, cleared whenever the terminal is resized
+_TERM_WIDTH = None
+
+def _reset_term_width(signum, frame):
+    global _TERM_WIDTH
+    _TERM_WIDTH = None
+
+# terminal width without an ioctl per call, 120 columns when not attached to a terminal
+def _term_width():
+    global _TERM_WIDTH
+    if _TERM_WIDTH is None:
+        try:
+            _TERM_WIDTH = os.get_terminal_size().columns
+        except OSError:
+            return 120
+        # POSIX only, and handlers can only be installed from the main thread
+        if hasattr(signal, 'SIGWINCH'):
+            try:
+                signal.signal(signal.SIGWINCH, _reset_term_width)
+            except ValueError:
+                pass
+    return _TERM_WIDTH or 120
 
 # fetch and list all app tokens available for the configured partner ID
 def list_app_tokens(client):
+    from KalturaClient.exceptions import KalturaException
     try:
-        # Create a new filter for App Tokens
-        filter = KalturaAppTokenFilter()
-        
-        # Create a new pager object
-        pager = KalturaFilterPager()
-        
-        # Fetch all App Tokens using the list method
-        result = client.appToken.list(filter, pager)
+        # Fetch all App Tokens, across as many pages as needed
+        app_tokens = fetch_all_app_tokens(client)
         
         # Check if there are any App Tokens to display
-        if not result.objects:
+        if not app_tokens:
             print("No App Tokens found.")
             return
         
         # Get the terminal width
-        terminal_width = os.get_terminal_size().columns
+        terminal_width = _term_width()
         
         # Define fixed column widths
         id_width = 15
@@ -145,80 +156,32 @@ def list_app_tokens(client):
         # Calculate dynamic width for privileges column
         privileges_width = terminal_width - fixed_widths - 6  # -6 for the separators and margins
 
-        # Print header
-        header_format = f"{{:<{id_width}}} | {{:<{value_width}}} | {{:<{description_width}}} | {{:<{privileges_width}}}"
-        print(header_format.format("App Token ID", "Value", "Description", "Session Privileges"))
-        print("-" * (terminal_width - 1))  # Adjust to terminal width
-        
-        # Print each app token in a row
-        for app_token in result.objects:
-            # Wrap the privileges string to avoid very long lines
-            wrapped_privileges = wrap_text(app_token.sessionPrivileges or '', privileges_width)
-            
-            # Print the first line with the token ID, value, and description
-            first_line_format = f"{{:<{id_width}}} | {{:<{value_width}}} | {{:<{description_width}}} | {{:<{privileges_width}}}"
-            print(first_line_format.format(app_token.id, app_token.token, app_token.description or '', wrapped_privileges[0] if wrapped_privileges else ''))
-            
-            # Print the subsequent lines for wrapped privileges
-            for line in wrapped_privileges[1:]:
-                print(f"{' ' * (id_width + value_width + description_width + 6)}| {line}")
-    except KalturaException as e:
-        print(f"Failed to list App Tokens: {e}")
-
-#  initiates a session using an application token
-def start_app_token_session(client, partner_id, app_token_id, app_token_value):
-    # Start an unprivileged session using session.startWidgetSession
-    widget_id = "_{0}".format(partner_id)  # Construct the widget ID
-    unprivileged_ks_response = client.session.startWidgetSession(widget_id)
-    unprivileged_ks = unprivileged_ks_response.ks  # Extracting the KS from the response object
-
-    if not unprivileged_ks:
-        raise Exception("Failed to start an unprivileged session.")
-
-    # Set the KS for the client to the unprivileged one
-    client.setKs(unprivileged_ks)
-
-    # Calculate the hash for the app token session
-    token_hash = hashlib.sha256((unprivileged_ks + app_token_value).encode('utf-8')).hexdigest()
-
-    # Start the app token session
-    app_token_session = client.appToken.startSession(app_token_id, token_hash, "", KalturaSessionType.USER, partner_id)
-    privileged_ks = app_token_session.ks  # Extracting the privileged KS
-
-    if not privileged_ks:
-        raise Exception("Failed to start a privileged session with the app token.")
-
-    # Set the KS for the client to the privileged one
-    client.setKs(privileged_ks)
+        # Row format and continuation padding are the same for every row, build them once
+        row_fmt = f"{{:<{id_width}}} | {{:<{value_width}}} | {{:<{description_width}}} | {{:<{privileges_width}}}"
+        cont_pad = ' ' * (id_width + value_width + description_width + 6) + '| '
 
-    return privileged_ks
+        # Collect the output lines and write them in one go
+        out = [row_fmt.format("App Token ID", "Value", "Description", "Session Privileges"),
+               "-" * (terminal_width - 1)]  # Adjust to terminal width
 
-import sys
+        # Add each app token in a row
+        for app_token in app_tokens:
+            # Wrap the privileges string to avoid very long lines
+            wrapped_privileges = wrap_text(app_token.sessionPrivileges or '', privileges_width)
 
-def load_configuration():
-    try:
-        with open('config.json', 'r') as config_file:
-            config_data = json.load(config_file)
-        return config_data
-    except FileNotFoundError:
-        raise Exception("Configuration file 'config.json' not found.")
-    except json.JSONDecodeError:
-        raise Exception("Configuration file 'config.json' contains invalid JSON.")
+            # The first line holds the token ID, value, and description
+            out.append(row_fmt.format(app_token.id, app_token.token, app_token.description or '', next(wrapped_privileges, '')))
 
-def initialize_client(config):
-    # Initialize the Kaltura configuration with the partner ID
-    kaltura_config = KalturaConfiguration(config['PARTNER_ID'])
-    kaltura_config.serviceUrl = config['KALTURA_SERVICE_URL']
-    # Create the Kaltura client with the configuration
-    client = KalturaClient(kaltura_config)
-    # this in case WAF is configured to prevent access from non-browser agents
-    client.requestHeaders = {
-        'sec-ch-ua': '"Chromium";v="118", "Google Chrome";v="118", "Not=A?Brand";v="99"',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
-    }
-    return client
+            # The subsequent lines hold the rest of the wrapped privileges
+            for line in wrapped_privileges:
+                out.append(cont_pad + line)
+        sys.stdout.write('\n'.join(out) + '\n')
+    except KalturaException as e:
+        print(f"Failed to list App Tokens: {e}")
 
 def start_admin_session(client, config):
+    from KalturaClient import KalturaClient
+    from KalturaClient.Plugins.Core import KalturaSessionType
     # Extract the necessary information from the configuration
     admin_secret = config.get('ADMIN_SECRET')
     user_id = config.get('USER_ID', '')  # Use empty string as default if USER_ID is not provided
@@ -226,16 +189,16 @@ def start_admin_session(client, config):
     expiry = config.get('EXPIRY', 86400)  # Default expiry to 24 hours if not provided
     privileges = config.get("DEFAULT_ADMIN_PRIVILEGES", '')  # Default privileges to empty if not provided
     
-    # Start the session
-    try:
-        ks = client.session.start(admin_secret, user_id, KalturaSessionType.ADMIN, partner_id, expiry, privileges)
-        print(f"KS: {ks}")
-        return ks
-    except KalturaException as e:
-        raise Exception(f"Failed to start session: {e}")
+    # Sign the admin KS locally with the admin secret, this needs no session.start round trip
+    if not admin_secret or not partner_id:
+        raise Exception("Failed to start session: ADMIN_SECRET and PARTNER_ID must be set in config.json")
+    ks = KalturaClient.generateSession(admin_secret, user_id, KalturaSessionType.ADMIN, partner_id, expiry, privileges).decode('ascii')
+    print(f"KS: {ks}")
+    return ks
 
 # handle updating an existing app token's privileges and description
 def update_app_token(client, app_token_id, privileges, description):
+    from KalturaClient.exceptions import KalturaException
     try:
         # Fetch the existing app token to update it
         app_token_to_update = client.appToken.get(app_token_id)
@@ -258,28 +221,61 @@ def update_app_token(client, app_token_id, privileges, description):
         print(f"Error updating App Token with ID {app_token_id}: {e}")
         return None
 
+# build the KalturaAppToken object to be added
+def build_app_token(privileges, description):
+    from KalturaClient.Plugins.Core import KalturaAppToken, KalturaSessionType, KalturaAppTokenHashType
+    # Create a new instance of the KalturaAppToken
+    app_token = KalturaAppToken()
+    app_token.description = description
+    app_token.sessionPrivileges = privileges
+    app_token.sessionType = KalturaSessionType.USER  # Or use KalturaSessionType.ADMIN based on your requirement
+    app_token.hashType = KalturaAppTokenHashType.SHA256  # Assuming SHA256 is the desired hash type
+    return app_token
+
+def print_new_app_token(new_app_token):
+    # Print the new token details
+    print(f"Created New App Token ID: {new_app_token.id}")
+    print(f"App Token Description: {new_app_token.description}")
+    print(f"App Token Session Privileges: {new_app_token.sessionPrivileges}")
+
 def create_app_token(client, privileges, description):
+    from KalturaClient.exceptions import KalturaException
     try:
-        # Create a new instance of the KalturaAppToken
-        app_token = KalturaAppToken()
-        app_token.description = description
-        app_token.sessionPrivileges = privileges
-        app_token.sessionType = KalturaSessionType.USER  # Or use KalturaSessionType.ADMIN based on your requirement
-        app_token.hashType = KalturaAppTokenHashType.SHA256  # Assuming SHA256 is the desired hash type
-
         # Add the new app token using the Kaltura API
-        new_app_token = client.appToken.add(app_token)
-
-        # Print the new token details
-        print(f"Created New App Token ID: {new_app_token.id}")
-        print(f"App Token Description: {new_app_token.description}")
-        print(f"App Token Session Privileges: {new_app_token.sessionPrivileges}")
-
+        new_app_token = client.appToken.add(build_app_token(privileges, description))
+        print_new_app_token(new_app_token)
         return new_app_token
     except KalturaException as e:
         print(f"Error creating new App Token: {e}")
         return None
 
+# create a new app token and start a session with it, batching appToken.add and
+# session.startWidgetSession into a single multirequest round trip
+def create_app_token_and_start_session(client, partner_id, privileges, description):
+    from KalturaClient.exceptions import KalturaException
+    client.startMultiRequest()
+    client.appToken.add(build_app_token(privileges, description))
+    client.session.startWidgetSession("_{0}".format(partner_id))
+    try:
+        new_app_token, widget_session = client.doMultiRequest()
+    except KalturaException as e:
+        # a failure of the whole batch leaves the client in multirequest mode, take it out
+        client.multiRequestReturnType = None
+        print(f"Error creating new App Token: {e}")
+        return None
+
+    # failed calls inside a multirequest are returned as exception objects rather than raised
+    if isinstance(new_app_token, KalturaException):
+        print(f"Error creating new App Token: {new_app_token}")
+        return None
+    print_new_app_token(new_app_token)
+    if isinstance(widget_session, KalturaException):
+        raise Exception(f"Failed to start an unprivileged session: {widget_session}")
+
+    # the token hash is computed locally from the widget KS, so startSession needs its own request
+    start_app_token_session(client, partner_id, new_app_token.id, new_app_token.token, widget_session.ks)
+    return new_app_token
+
 def main():
     parser = setup_parser()
     args = parser.parse_args()
@@ -307,24 +303,16 @@ def run_application(args):
         process_app_token_arguments(client, args, config)
 
 def process_app_token_arguments(client, args, config):
-    new_token_id = None
-    new_token_value = None
     privileges = build_privileges(args)
     if hasattr(args, 'update') and args.update:
         # If an update ID is provided, update the token, otherwise create a new one
-        update_app_token(client, args.update, build_privileges(args), args.description)
+        update_app_token(client, args.update, privileges, args.description)
+    elif args.start_session:
+        # Create the token and start a session with it, batching the API calls
+        create_app_token_and_start_session(client, config.get('PARTNER_ID'), privileges, args.description)
     else:
         # Assume we want to create a new token if we're not updating
-        new_app_token = create_app_token(client, build_privileges(args), args.description)
-        if new_app_token:
-            new_token_id = new_app_token.id
-            new_token_value = new_app_token.token  # Assuming the token value is returned here
-
-    # Start session with app token if requested
-    if args.start_session:
-        # Ensure new_token_id and new_token_value are not None before calling
-        if new_token_id and new_token_value:
-            start_app_token_session(client, config.get('PARTNER_ID'), new_token_id, new_token_value)
+        create_app_token(client, privileges, args.description)
 
 if __name__ == "__main__":
     main()
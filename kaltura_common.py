@@ -0,0 +1,162 @@
+# Helpers shared by kaltura_app_token_manager.py and kapptokens.py
+import hashlib
+import json
+import functools
+import logging
+# orjson is optional, it parses faster than the standard library when installed;
+# its JSONDecodeError subclasses json.JSONDecodeError so error handling is the same
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+_loads = _json.loads
+
+# KalturaClient (and requests) are imported inside the functions that use them,
+# loading the generated API classes is slow and not needed for --help or argument errors
+
+# route log records to stderr at DEBUG level, unless the root logger is already configured
+def enable_debug_logging():
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(level=logging.DEBUG)
+
+# Custom logger class, call enable_debug_logging() once for its output to be shown
+class KalturaLogger:
+    def __init__(self):
+        self.logger = logging.getLogger('KalturaClient')
+
+    def log(self, msg):
+        self.logger.info(msg)
+
+    def debug(self, msg):
+        self.logger.debug(msg)
+
+#  initiates a session using an application token
+#  an unprivileged KS already fetched (e.g. batched with appToken.add) can be passed to skip the widget session call
+def start_app_token_session(client, partner_id, app_token_id, app_token_value, unprivileged_ks=None):
+    if unprivileged_ks is None:
+        # Start an unprivileged session using session.startWidgetSession
+        widget_id = "_{0}".format(partner_id)  # Construct the widget ID
+        unprivileged_ks_response = client.session.startWidgetSession(widget_id)
+        unprivileged_ks = unprivileged_ks_response.ks  # Extracting the KS from the response object
+
+    if not unprivileged_ks:
+        raise Exception("Failed to start an unprivileged session.")
+
+    # Set the KS for the client to the unprivileged one
+    client.setKs(unprivileged_ks)
+
+    # Calculate the hash for the app token session
+    # KS and token values are ASCII, feed them to the hash separately rather than concatenating
+    hasher = hashlib.sha256()
+    hasher.update(unprivileged_ks.encode('ascii'))
+    hasher.update(app_token_value.encode('ascii'))
+    token_hash = hasher.hexdigest()
+
+    # Start the app token session, the user, type and expiry default to the ones set on the app token
+    app_token_session = client.appToken.startSession(app_token_id, token_hash)
+    privileged_ks = app_token_session.ks  # Extracting the privileged KS
+
+    if not privileged_ks:
+        raise Exception("Failed to start a privileged session with the app token.")
+
+    # Set the KS for the client to the privileged one
+    client.setKs(privileged_ks)
+
+    return privileged_ks
+
+# parse a configuration file only once per process
+@functools.lru_cache(maxsize=None)
+def _read_configuration(path):
+    with open(path, 'rb') as config_file:
+        return _loads(config_file.read())
+
+def load_configuration():
+    try:
+        return _read_configuration('config.json')
+    except FileNotFoundError:
+        raise Exception("Configuration file 'config.json' not found.")
+    except json.JSONDecodeError:
+        raise Exception("Configuration file 'config.json' contains invalid JSON.")
+
+# builds a replacement for KalturaClient.openRequestUrl that posts through a pooled keep-alive session
+def session_request_opener(http_session):
+    from KalturaClient import KalturaClient
+    from KalturaClient.exceptions import KalturaClientException
+    def open_request_url(url, params, files, request_headers, request_timeout):
+        # file uploads need the multipart encoder, leave those to the stock implementation
+        if files:
+            return KalturaClient.openRequestUrl(url, params, files, request_headers, request_timeout)
+        request_headers['Accept'] = 'text/xml'
+        request_headers['Accept-encoding'] = 'gzip'
+        request_headers['Content-Type'] = 'application/json'
+        try:
+            if not params.get():
+                return http_session.post(url, headers=request_headers, timeout=request_timeout)
+            return http_session.post(url, json=params.get(), headers=request_headers, timeout=request_timeout)
+        except Exception as e:
+            raise KalturaClientException(e, KalturaClientException.ERROR_CONNECTION_FAILED)
+    return open_request_url
+
+def initialize_client(config, logger=None):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from KalturaClient import KalturaClient, KalturaConfiguration
+    # Initialize the Kaltura configuration with the partner ID
+    kaltura_config = KalturaConfiguration(config['PARTNER_ID'])
+    kaltura_config.serviceUrl = config['KALTURA_SERVICE_URL']
+    if logger:
+        kaltura_config.setLogger(logger)
+    # Create the Kaltura client with the configuration
+    client = KalturaClient(kaltura_config)
+    # this in case WAF is configured to prevent access from non-browser agents
+    client.requestHeaders = {
+        'sec-ch-ua': '"Chromium";v="118", "Google Chrome";v="118", "Not=A?Brand";v="99"',
+        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36',
+        'Connection': 'keep-alive'
+    }
+    # reuse one pooled HTTPS connection for all API calls instead of a new TLS handshake per call
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    client._http_session = http_session
+    client.openRequestUrl = session_request_opener(http_session)
+    return client
+
+# Largest page size the appToken.list API accepts
+APP_TOKEN_PAGE_SIZE = 500
+
+# fetch every app token of the partner; the first page tells how many there are,
+# the remaining pages are requested together in a single multirequest
+def fetch_all_app_tokens(client):
+    from KalturaClient.Plugins.Core import KalturaAppTokenFilter, KalturaFilterPager
+    from KalturaClient.exceptions import KalturaException
+    filter = KalturaAppTokenFilter()
+
+    def page(index):
+        pager = KalturaFilterPager()
+        pager.pageSize = APP_TOKEN_PAGE_SIZE
+        pager.pageIndex = index
+        return pager
+
+    first = client.appToken.list(filter, page(1))
+    app_tokens = list(first.objects or [])
+    n_pages = -(-(first.totalCount or 0) // APP_TOKEN_PAGE_SIZE)
+    if n_pages <= 1:
+        return app_tokens
+
+    client.startMultiRequest()
+    for index in range(2, n_pages + 1):
+        client.appToken.list(filter, page(index))
+    try:
+        results = client.doMultiRequest()
+    except KalturaException:
+        # a failure of the whole batch leaves the client in multirequest mode, take it out
+        client.multiRequestReturnType = None
+        raise
+    for result in results:
+        # failed calls inside a multirequest are returned as exception objects rather than raised
+        if isinstance(result, KalturaException):
+            raise result
+        app_tokens.extend(result.objects or [])
+    return app_tokens
@@ -1,46 +1,6 @@
+import sys
 import argparse
-import logging
-from KalturaClient import KalturaClient, KalturaConfiguration
-from KalturaClient.Plugins.Core import KalturaAppToken, KalturaAppTokenFilter, KalturaFilterPager, KalturaSessionType
-from KalturaClient.exceptions import KalturaException
-import hashlib
-import json
-
-# Custom logger class
-class KalturaLogger:
-    def __init__(self):
-        self.logger = logging.getLogger('KalturaClient')
-        logging.basicConfig(level=logging.DEBUG)
-
-    def log(self, msg):
-        self.logger.info(msg)
-
-    def debug(self, msg):
-        self.logger.debug(msg)
-
-def start_app_token_session(client, partner_id, app_token_id, app_token_value):
-    # Start an unprivileged session using session.startWidgetSession
-    widget_id = f"_{partner_id}"  # Replace with your actual Partner ID
-    unprivileged_ks_response = client.session.startWidgetSession(widget_id)
-    unprivileged_ks = unprivileged_ks_response.ks  # Extracting the ks from the response object
-    
-    if not unprivileged_ks:
-        print("Failed to get an unprivileged ks.")
-        return None
-    
-    client.setKs(unprivileged_ks)
-
-    # Compute the Hash
-    hash_string = hashlib.sha256((unprivileged_ks + app_token_value).encode('ascii')).hexdigest()
-
-    # Start the App Token Session using appToken.startSession
-    app_token_session = client.appToken.startSession(app_token_id, hash_string)
-    privileged_ks = app_token_session.ks  # Again, extract the ks
-
-    # Set the new KS
-    client.setKs(privileged_ks)
-
-    return privileged_ks
+from kaltura_common import KalturaLogger, enable_debug_logging, start_app_token_session, load_configuration, initialize_client, fetch_all_app_tokens
 
 def build_uri_privilege(list_actions):
     uris = []
@@ -53,18 +13,18 @@ def build_uri_privilege(list_actions):
     return uris
 
 def list_app_tokens(client):
-    filter = KalturaAppTokenFilter()
-    pager = KalturaFilterPager()
-    
-    # Fetch all App Tokens
-    result = client.appToken.list(filter, pager)
+    # Fetch all App Tokens, across as many pages as needed
+    app_tokens = fetch_all_app_tokens(client)
     
-    # Print the list of App Tokens
-    for app_token in result.objects:
-        print(f"App Token ID: {app_token.id}")
-        print(f"App Token Value: {app_token.token}")
-        print(f"App Token Description: {app_token.description}")
-        print("------")
+    # Collect the list of App Tokens and print it with a single write
+    lines = []
+    for app_token in app_tokens:
+        lines.append(f"App Token ID: {app_token.id}")
+        lines.append(f"App Token Value: {app_token.token}")
+        lines.append(f"App Token Description: {app_token.description}")
+        lines.append("------")
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 def main():
     parser = argparse.ArgumentParser(description='Manage Kaltura App Tokens.')
@@ -108,26 +68,23 @@ def main():
 
     list_actions = args.actions.lower().split(',') if args.actions else None
 
+    # Import the Kaltura client only once the arguments are valid, it is slow to load
+    from KalturaClient.Plugins.Core import KalturaAppToken, KalturaSessionType
+    from KalturaClient.exceptions import KalturaException
+
     # Load configuration from JSON file
-    with open('config.json', 'r') as f:
-        config_data = json.load(f)
+    config_data = load_configuration()
     PARTNER_ID = config_data['PARTNER_ID']
     ADMIN_SECRET = config_data['ADMIN_SECRET']
     SCRIPT_USER_ID = config_data['SCRIPT_USER_ID']
     ADMIN_SESSION_EXPIRY = config_data['ADMIN_SESSION_EXPIRY']
-    KALTURA_SERVICE_URL = config_data['KALTURA_SERVICE_URL']
 
-    # Initialize the Kaltura client
-    config = KalturaConfiguration(PARTNER_ID)
-    config.serviceUrl = KALTURA_SERVICE_URL
+    # Initialize the Kaltura client, logging its requests only when debugging
+    kaltura_logger = None
     if args.debug:
+        enable_debug_logging()
         kaltura_logger = KalturaLogger()
-        config.setLogger(kaltura_logger)
-    client = KalturaClient(config)
-    client.requestHeaders = {
-        'sec-ch-ua': '"Chromium";v="118", "Google Chrome";v="118", "Not=A?Brand";v="99"',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
-    }
+    client = initialize_client(config_data, kaltura_logger)
     
     # Start an admin-level Kaltura session using your Admin Secret
     ks = client.session.start(ADMIN_SECRET, SCRIPT_USER_ID, KalturaSessionType.ADMIN, PARTNER_ID, ADMIN_SESSION_EXPIRY, '')
@@ -162,11 +119,12 @@ def main():
             new_uris = build_uri_privilege(list_actions)
             existing_uris.extend(new_uris)
             
-            # Remove duplicates
-            unique_uris = list(set(existing_uris))
+            # Remove duplicates, keeping the original order
+            unique_uris = list(dict.fromkeys(existing_uris))
             
             # Convert back to string
-            existing_app_token.sessionPrivileges = "urirestrict:" + "|".join(unique_uris)
+            joined_uris = '|'.join(unique_uris)
+            existing_app_token.sessionPrivileges = "urirestrict:" + joined_uris
         else:
             existing_app_token.sessionPrivileges = build_uri_privilege(list_actions)
         